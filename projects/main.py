@@ -1,5 +1,12 @@
 import os
 import asyncio
+import hashlib
+import hmac
+import json
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from urllib.parse import parse_qsl
+from datetime import datetime
 from threading import Thread
 from flask import Flask, jsonify, send_file, request
 from aiogram import Bot, Dispatcher, types
@@ -63,6 +70,22 @@ def init_db():
             added_at TIMESTAMP DEFAULT now()
         );
     """)
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS orders (
+            id SERIAL PRIMARY KEY,
+            user_id BIGINT NOT NULL,
+            product_id INTEGER REFERENCES products(id) ON DELETE SET NULL,
+            account_id INTEGER REFERENCES accounts(id) ON DELETE SET NULL,
+            product_name TEXT NOT NULL,
+            price REAL NOT NULL,
+            login TEXT NOT NULL,
+            password TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+    """)
+    # keyset pagination for /orders walks this index, so a page costs the same no matter how many orders exist
+    cur.execute("CREATE INDEX IF NOT EXISTS orders_user_visible_idx ON orders (user_id, created_at DESC, id DESC) WHERE status <> 'failed';")
     conn.commit()
     cur.close()
     conn.close()
@@ -148,17 +171,23 @@ def add_accounts_to_db(product_name: str, accounts: list):
     cur.close()
     conn.close()
 
-def fetch_and_mark_account(product_name: str):
+def fetch_and_mark_account(product_name: str, user_id: int):
     conn = get_db_connection()
     try:
         cur = conn.cursor()
-        cur.execute("SELECT id FROM products WHERE name = %s FOR SHARE;", (product_name,))
+        cur.execute("SELECT id, price FROM products WHERE name = %s FOR SHARE;", (product_name,))
         prod = cur.fetchone()
         if not prod:
             cur.close()
             conn.close()
             return None
         product_id = prod['id']
+        price = prod['price']
+        # check and debit the balance in the same transaction that hands out the account
+        cur.execute("SELECT balance FROM users WHERE user_id = %s FOR UPDATE;", (user_id,))
+        user = cur.fetchone()
+        if not user or user['balance'] < price:
+            raise ValueError("Недостаточно средств")
         cur.execute("""
             SELECT id, login, password FROM accounts
             WHERE product_id = %s AND used = FALSE
@@ -177,10 +206,22 @@ def fetch_and_mark_account(product_name: str):
         password = acc['password']
         cur.execute("UPDATE accounts SET used = TRUE WHERE id = %s;", (account_id,))
         cur.execute("UPDATE products SET stock = GREATEST(stock - 1, 0) WHERE id = %s;", (product_id,))
+        cur.execute("UPDATE users SET balance = balance - %s WHERE user_id = %s;", (price, user_id))
+        cur.execute("""
+            INSERT INTO orders (user_id, product_id, account_id, product_name, price, login, password)
+            VALUES (%s, %s, %s, %s, %s, %s, %s)
+            RETURNING id;
+        """, (user_id, product_id, account_id, product_name, price, login, password))
+        order_id = cur.fetchone()['id']
         conn.commit()
         cur.close()
         conn.close()
-        return {"login": login, "password": password}
+        return {"login": login, "password": password, "price": price, "order_id": order_id}
+    except ValueError:
+        conn.rollback()
+        cur.close()
+        conn.close()
+        raise
     except Exception as e:
         conn.rollback()
         cur.close()
@@ -188,6 +229,82 @@ def fetch_and_mark_account(product_name: str):
         print(f"[DB ERROR fetch_and_mark_account] {e}")
         return None
 
+# ---------- Orders helpers ----------
+def set_order_status(order_id: int, status: str):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("UPDATE orders SET status = %s WHERE id = %s;", (status, order_id))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+def refund_order(order_id: int):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    cur.execute("UPDATE orders SET status = 'failed' WHERE id = %s AND status = 'pending' RETURNING user_id, price;", (order_id,))
+    order = cur.fetchone()
+    if order:
+        cur.execute("UPDATE users SET balance = balance + %s WHERE user_id = %s;", (order['price'], order['user_id']))
+    conn.commit()
+    cur.close()
+    conn.close()
+
+def settle_order(order_id: int, future):
+    # called once send_product finishes after buy_product stopped waiting for it
+    try:
+        if future.cancelled() or future.exception():
+            refund_order(order_id)
+        else:
+            set_order_status(order_id, "delivered")
+    except Exception as e:
+        print(f"[DB ERROR settle_order] {e}")
+
+def fetch_user_orders(user_id: int, limit: int, before=None):
+    conn = get_db_connection()
+    cur = conn.cursor()
+    # fetch one extra row to know whether another page exists
+    if before:
+        cur.execute("""
+            SELECT id, product_name, price, login, password, status, created_at FROM orders
+            WHERE user_id = %s AND status <> 'failed' AND (created_at, id) < (%s, %s)
+            ORDER BY created_at DESC, id DESC
+            LIMIT %s;
+        """, (user_id, before[0], before[1], limit + 1))
+    else:
+        cur.execute("""
+            SELECT id, product_name, price, login, password, status, created_at FROM orders
+            WHERE user_id = %s AND status <> 'failed'
+            ORDER BY created_at DESC, id DESC
+            LIMIT %s;
+        """, (user_id, limit + 1))
+    rows = cur.fetchall()
+    cur.close()
+    conn.close()
+    return rows[:limit], len(rows) > limit
+
+# ---------- WEBAPP AUTH ----------
+INIT_DATA_MAX_AGE = 24 * 3600
+
+def verify_init_data(init_data: str):
+    """Check Telegram.WebApp.initData signature and return the user id it was issued for."""
+    if not init_data or not BOT_TOKEN:
+        return None
+    fields = dict(parse_qsl(init_data, keep_blank_values=True))
+    received_hash = fields.pop("hash", None)
+    if not received_hash:
+        return None
+    data_check_string = "\n".join(f"{k}={v}" for k, v in sorted(fields.items()))
+    secret_key = hmac.new(b"WebAppData", BOT_TOKEN.encode(), hashlib.sha256).digest()
+    expected_hash = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
+    if not hmac.compare_digest(expected_hash, received_hash):
+        return None
+    try:
+        if time.time() - int(fields.get("auth_date", 0)) > INIT_DATA_MAX_AGE:
+            return None
+        return int(json.loads(fields["user"])["id"])
+    except (KeyError, ValueError, TypeError):
+        return None
+
 # ---------- FLASK ----------
 app = Flask(__name__)
 bot_loop = None
@@ -214,27 +331,72 @@ def get_balance():
         print(f"[Flask ERROR] {e}")
         return jsonify({"balance": 0})
 
+@app.route("/orders")
+def get_orders():
+    # orders carry credentials, so the user id must come from signed initData, not from the query string
+    user_id = verify_init_data(request.headers.get("X-Telegram-Init-Data", ""))
+    if not user_id:
+        return jsonify({"status": "error", "error": "Unauthorized"}), 401
+    try:
+        limit = min(max(int(request.args.get("limit", 20)), 1), 50)
+        before = None
+        cursor = request.args.get("cursor")
+        if cursor:
+            # cursor is "<created_at ISO>|<order id>" of the last order on the previous page
+            created_at, order_id = cursor.rsplit("|", 1)
+            before = (datetime.fromisoformat(created_at), int(order_id))
+        orders, has_more = fetch_user_orders(user_id, limit, before)
+    except ValueError:
+        return jsonify({"status": "error", "error": "Invalid parameters"}), 400
+    except Exception as e:
+        print(f"[Flask ERROR] {e}")
+        return jsonify({"orders": [], "next_cursor": None})
+    next_cursor = None
+    if has_more:
+        last = orders[-1]
+        next_cursor = f"{last['created_at'].isoformat()}|{last['id']}"
+    return jsonify({
+        "orders": [
+            {
+                "id": o["id"],
+                "product_name": o["product_name"],
+                "price": o["price"],
+                "login": o["login"],
+                "password": o["password"],
+                "status": o["status"],
+                "created_at": o["created_at"].isoformat(),
+            }
+            for o in orders
+        ],
+        "next_cursor": next_cursor,
+    })
+
 @app.route("/buy_product", methods=["POST"])
 def buy_product():
     data = request.json
     user_id = int(data.get("telegram_user_id", 0))
     product_name = data.get("product_name")
-    price = float(data.get("price", 0))
     if not all([user_id, product_name]):
         return jsonify({"status": "error", "error": "Missing fields"}), 400
-    current_balance = get_user_balance(user_id)
-    if current_balance < price:
-        return jsonify({"status": "error", "error": "Недостаточно средств"}), 400
-    account = fetch_and_mark_account(product_name)
+    try:
+        account = fetch_and_mark_account(product_name, user_id)
+    except ValueError as e:
+        return jsonify({"status": "error", "error": str(e)}), 400
     if not account:
         return jsonify({"status": "error", "error": "Нет доступных аккаунтов для данного товара"}), 400
     future = asyncio.run_coroutine_threadsafe(send_product(user_id, product_name, account), bot_loop)
     try:
         future.result(timeout=10)
+    except FutureTimeoutError:
+        # send_product may still deliver; the order stays pending (and paid) until it finishes
+        order_id = account["order_id"]
+        future.add_done_callback(lambda f: settle_order(order_id, f))
+        return jsonify({"status": "ok"})
     except Exception as e:
         print(f"Error sending product notification: {e}")
+        refund_order(account["order_id"])
         return jsonify({"status": "error", "error": "Failed to send notification"}), 500
-    update_user_balance(user_id, current_balance - price)
+    set_order_status(account["order_id"], "delivered")
     return jsonify({"status": "ok"})
 
 @app.route("/admin/add_accounts", methods=["POST"])